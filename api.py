@@ -1,20 +1,48 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException, Header, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, PlainTextResponse
 from pydantic import BaseModel, Field
-import tempfile
+import asyncio
+import fcntl
+import hashlib
+import re
+import subprocess
 import shutil
 import os
-from git import Repo
-import requests
 from typing import Optional
-from extractor import extract_repository_structure
-from processor import generate_mermaid_diagram
+from extractor import extract_repository_structure, run_git
+from processor import (
+    OLLAMA_MODEL, OLLAMA_METRICS, generate_mermaid_diagram, open_session, close_session,
+    ollama_status, warm_model
+)
+from cache import RESULT_CACHE, LLM_CACHE
+
+HEALTH_POLL_INTERVAL_SECONDS = 10
+
+async def poll_ollama_status(app: FastAPI) -> None:
+    while True:
+        app.state.ollama_status = await ollama_status()
+        await asyncio.sleep(HEALTH_POLL_INTERVAL_SECONDS)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await open_session()
+    app.state.ollama_status = "disconnected"
+    poller = asyncio.create_task(poll_ollama_status(app))
+    warmup = asyncio.create_task(warm_model())
+    yield
+    warmup.cancel()
+    poller.cancel()
+    await close_session()
 
 app = FastAPI(
     title="Architecture Generator Service",
     description="Servicio que analiza repositorios Git y genera diagramas Mermaid",
-    version="2.0.0"
+    version="2.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 app.add_middleware(
@@ -25,10 +53,22 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-OLLAMA_API_URL = os.getenv("OLLAMA_API_URL", "http://localhost:11434")
-OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "llama3.2:3b-instruct-q4_0")
 API_KEY = os.getenv("API_KEY", "")
 MAX_REPO_SIZE_MB = 100
+CLONE_TIMEOUT_SECONDS = 300
+LS_REMOTE_TIMEOUT_SECONDS = 30
+MAX_CLONES = int(os.getenv("MAX_CLONES", "4"))
+CLONE_DIR = os.getenv("ARQ_CLONE_DIR", "/tmp/arqgen-clones")
+MAX_CACHED_CLONES = int(os.getenv("ARQ_MAX_CACHED_CLONES", "16"))
+CLONE_LOCK_POLL_SECONDS = 0.2
+CLONE_LOCK_TIMEOUT_SECONDS = 300
+
+CLONE_SEMAPHORE = asyncio.Semaphore(MAX_CLONES)
+
+REPO_URL_RE = re.compile(
+    r"(?:https?://|git://|git@)"
+    r"(?:(?:[^/@\s]+@)?(?i:(?:www\.)?(?:github\.com|gitlab\.com|bitbucket\.org))[:/]|\S*\.git\Z)"
+)
 
 security = HTTPBearer(auto_error=False)
 
@@ -55,51 +95,199 @@ class AnalyzeRequest(BaseModel):
     depth: int = Field(default=1, ge=1, le=3, description="Profundidad del clone (1-3)")
 
 def validate_repo_url(url: str) -> bool:
-    valid_prefixes = ("http://", "https://", "git@", "git://")
-    return url.startswith(valid_prefixes) and ("github.com" in url or "gitlab.com" in url or "bitbucket.org" in url or url.endswith(".git"))
+    return REPO_URL_RE.match(url) is not None
+
+def run_git_remote(*args: str) -> None:
+    result = subprocess.run(
+        ["git", *args],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        timeout=CLONE_TIMEOUT_SECONDS,
+        env={**os.environ, "GIT_TERMINAL_PROMPT": "0"}
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.decode("utf-8", errors="replace").strip())
+
+def clone_repository(repo_url: str, path: str, depth: int) -> None:
+    run_git_remote(
+        "clone", "--quiet", "--filter=blob:none", "--no-checkout",
+        "--single-branch", "--no-tags", f"--depth={depth}", "--", repo_url, path
+    )
+
+def clone_path(repo_url: str, depth: int) -> str:
+    return os.path.join(CLONE_DIR, hashlib.sha1(f"{repo_url}|{depth}".encode()).hexdigest())
+
+def update_repository(repo_url: str, path: str, depth: int) -> None:
+    if os.path.isdir(os.path.join(path, ".git")):
+        try:
+            run_git_remote(
+                "-C", path, "fetch", "--quiet", "--filter=blob:none",
+                "--no-tags", f"--depth={depth}", "origin", "HEAD"
+            )
+            run_git(path, "update-ref", "HEAD", "FETCH_HEAD")
+            # Los objetos de commits anteriores se acumulan: si el clone reutilizado
+            # supera el límite se descarta y se mide sobre uno limpio.
+            if repo_size_mb(path) <= MAX_REPO_SIZE_MB:
+                os.utime(path)
+                return
+        except Exception:
+            pass
+        shutil.rmtree(path, ignore_errors=True)
+    
+    clone_repository(repo_url, path, depth)
+    os.utime(path)
+
+def is_current_lock(fd: int, lock_path: str) -> bool:
+    try:
+        return os.stat(lock_path).st_ino == os.fstat(fd).st_ino
+    except FileNotFoundError:
+        return False
+
+async def lock_clone(path: str) -> int:
+    os.makedirs(CLONE_DIR, exist_ok=True)
+    lock_path = f"{path}.lock"
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + CLONE_LOCK_TIMEOUT_SECONDS
+    fd = os.open(lock_path, os.O_CREAT | os.O_RDWR)
+    try:
+        # Se sondea sin bloquear para no ocupar hilos del pool mientras otra petición
+        # usa el mismo clone.
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                if loop.time() >= deadline:
+                    raise HTTPException(
+                        status_code=503,
+                        detail="El repositorio está siendo analizado por otra petición, inténtalo de nuevo en unos minutos"
+                    )
+                await asyncio.sleep(CLONE_LOCK_POLL_SECONDS)
+                continue
+            
+            # evict_clones borra el fichero de lock: si ya no es el que tenemos abierto
+            # hay que bloquear el nuevo.
+            if is_current_lock(fd, lock_path):
+                return fd
+            os.close(fd)
+            fd = os.open(lock_path, os.O_CREAT | os.O_RDWR)
+    except BaseException:
+        os.close(fd)
+        raise
+
+def evict_clones() -> None:
+    try:
+        entries = list(os.scandir(CLONE_DIR))
+    except OSError:
+        return
+    
+    clones = [entry for entry in entries if entry.is_dir(follow_symlinks=False)]
+    clones.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    stale = [entry.path for entry in clones[MAX_CACHED_CLONES:]]
+    # Locks de clones descartados (por tamaño o por un clone fallido).
+    names = {entry.name for entry in clones}
+    stale += [
+        entry.path[:-len(".lock")] for entry in entries
+        if entry.name.endswith(".lock") and entry.name[:-len(".lock")] not in names
+    ]
+    
+    for path in stale:
+        lock_path = f"{path}.lock"
+        fd = os.open(lock_path, os.O_CREAT | os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # Otro evict_clones puede haber borrado ya el lock y una petición
+            # nueva estar usando uno recién creado.
+            if is_current_lock(fd, lock_path):
+                shutil.rmtree(path, ignore_errors=True)
+                os.remove(lock_path)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+def remote_head_sha(repo_url: str) -> Optional[str]:
+    try:
+        result = subprocess.run(
+            ["git", "ls-remote", "--", repo_url, "HEAD"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            timeout=LS_REMOTE_TIMEOUT_SECONDS,
+            env={**os.environ, "GIT_TERMINAL_PROMPT": "0"}
+        )
+    except subprocess.TimeoutExpired:
+        return None
+    fields = result.stdout.split()
+    if result.returncode != 0 or not fields:
+        return None
+    return fields[0].decode()
+
+def repo_size_mb(repo_path: str) -> float:
+    stats = dict(
+        line.split(": ", 1)
+        for line in run_git(repo_path, "count-objects", "-v").decode().splitlines()
+    )
+    return (int(stats.get("size", 0)) + int(stats.get("size-pack", 0))) / 1024
+
+def cache_key_for(req: AnalyzeRequest, head_sha: str) -> str:
+    return f"{req.repo_url}|{req.depth}|{head_sha}|{OLLAMA_MODEL}"
 
 @app.post("/analyze", dependencies=[Depends(verify_api_key)])
-def analyze(req: AnalyzeRequest):
+async def analyze(req: AnalyzeRequest):
     if not validate_repo_url(req.repo_url):
         raise HTTPException(
             status_code=400, 
             detail="URL de repositorio inválida. Debe ser de GitHub, GitLab o Bitbucket."
         )
     
-    tmp = tempfile.mkdtemp(prefix="repo_analyze_")
+    remote_sha = await asyncio.to_thread(remote_head_sha, req.repo_url)
+    if remote_sha:
+        cached = await asyncio.to_thread(RESULT_CACHE.get, cache_key_for(req, remote_sha))
+        if cached is not None:
+            return cached
+    
+    tmp = clone_path(req.repo_url, req.depth)
     
     try:
+        lock_fd = await lock_clone(tmp)
         try:
-            Repo.clone_from(
-                req.repo_url, 
-                tmp, 
-                depth=req.depth,
-                single_branch=True
-            )
-        except Exception as e:
-            raise HTTPException(
-                status_code=400, 
-                detail=f"Error al clonar repositorio: {str(e)}"
-            )
+            try:
+                async with CLONE_SEMAPHORE:
+                    await asyncio.to_thread(update_repository, req.repo_url, tmp, req.depth)
+            except Exception as e:
+                raise HTTPException(
+                    status_code=400, 
+                    detail=f"Error al clonar repositorio: {str(e)}"
+                )
+            
+            head_sha = (await asyncio.to_thread(run_git, tmp, "rev-parse", "HEAD")).decode().strip()
+            cache_key = cache_key_for(req, head_sha)
+            # Otra petición puede haber generado el diagrama mientras se esperaba el lock.
+            cached = await asyncio.to_thread(RESULT_CACHE.get, cache_key)
+            if cached is not None:
+                return cached
+            
+            total_size = await asyncio.to_thread(repo_size_mb, tmp)
+            
+            if total_size > MAX_REPO_SIZE_MB:
+                await asyncio.to_thread(shutil.rmtree, tmp, ignore_errors=True)
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Repositorio demasiado grande ({total_size:.1f}MB). Máximo: {MAX_REPO_SIZE_MB}MB"
+                )
+            
+            async with CLONE_SEMAPHORE:
+                structure = await asyncio.to_thread(extract_repository_structure, tmp, max_depth=req.depth)
+        finally:
+            os.close(lock_fd)
+            asyncio.get_running_loop().run_in_executor(None, evict_clones)
         
-        total_size = sum(
-            os.path.getsize(os.path.join(dirpath, filename))
-            for dirpath, dirnames, filenames in os.walk(tmp)
-            for filename in filenames
-        ) / (1024 * 1024)
+        mermaid_code = await generate_mermaid_diagram(structure)
         
-        if total_size > MAX_REPO_SIZE_MB:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Repositorio demasiado grande ({total_size:.1f}MB). Máximo: {MAX_REPO_SIZE_MB}MB"
-            )
-        
-        structure = extract_repository_structure(tmp, max_depth=req.depth)
-        mermaid_code = generate_mermaid_diagram(structure)
-        
-        return {
+        result = {
             "mermaid": mermaid_code
         }
+        await asyncio.to_thread(RESULT_CACHE.set, cache_key, result)
+        return result
     
     except HTTPException:
         raise
@@ -108,23 +296,38 @@ def analyze(req: AnalyzeRequest):
             status_code=500,
             detail=f"Error interno: {str(e)}"
         )
-    finally:
-        try:
-            shutil.rmtree(tmp)
-        except Exception:
-            pass
+
+@app.post("/cache/clear", dependencies=[Depends(verify_api_key)])
+async def clear_cache():
+    results = await asyncio.to_thread(RESULT_CACHE.clear)
+    llm_responses = await asyncio.to_thread(LLM_CACHE.clear)
+    return {
+        "status": "ok",
+        "results": results,
+        "llm_responses": llm_responses
+    }
 
 @app.get("/health")
-def health():
-    try:
-        response = requests.get(f"{OLLAMA_API_URL}/api/tags", timeout=5)
-        ollama_status = "connected" if response.status_code == 200 else "disconnected"
-    except Exception:
-        ollama_status = "disconnected"
-    
+async def health():
     return {
         "status": "ok",
-        "ollama": ollama_status,
-        "model": OLLAMA_MODEL
+        "ollama": app.state.ollama_status,
+        "model": OLLAMA_MODEL,
+        "llm_cache": LLM_CACHE.stats()
     }
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    values = {
+        "arqgen_ollama_in_flight": OLLAMA_METRICS["in_flight"],
+        "arqgen_ollama_queued": OLLAMA_METRICS["queued"],
+        "arqgen_ollama_rejected_total": OLLAMA_METRICS["rejected"],
+        "arqgen_ollama_generations_total": OLLAMA_METRICS["generations"],
+        "arqgen_ollama_generation_seconds_total": OLLAMA_METRICS["generation_seconds"],
+        "arqgen_ollama_failures_total": OLLAMA_METRICS["failures"],
+        "arqgen_result_cache_hits_total": RESULT_CACHE.hits,
+        "arqgen_result_cache_misses_total": RESULT_CACHE.misses,
+        "arqgen_llm_cache_hits_total": LLM_CACHE.hits,
+        "arqgen_llm_cache_misses_total": LLM_CACHE.misses
+    }
+    return "".join(f"{name} {value}\n" for name, value in values.items())
@@ -0,0 +1,87 @@
+import os
+import time
+import hashlib
+import threading
+import orjson
+from typing import Any, Optional
+from cachetools import TTLCache
+
+CACHE_DIR = os.getenv("ARQ_CACHE_DIR", "/tmp/arqgen-cache")
+CACHE_TTL_SECONDS = int(os.getenv("ARQ_CACHE_TTL_SECONDS", "3600"))
+CACHE_MAX_ENTRIES = 128
+
+class ResultCache:
+    def __init__(self, directory: str, ttl: int, maxsize: int):
+        self.directory = directory
+        self.ttl = ttl
+        self.memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        # TTLCache no es thread-safe y get/set se llaman desde asyncio.to_thread.
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest() + ".json")
+    
+    def get(self, key: str) -> Optional[Any]:
+        with self.lock:
+            value = self.memory.get(key)
+            if value is not None:
+                self.hits += 1
+                return value
+        
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+            else:
+                with open(path, "rb") as fh:
+                    value = orjson.loads(fh.read())
+        except (OSError, ValueError):
+            pass
+        
+        with self.lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.memory[key] = value
+        return value
+    
+    def clear(self) -> int:
+        with self.lock:
+            self.memory.clear()
+        
+        removed = 0
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError:
+            return removed
+        for entry in entries:
+            if entry.name.endswith(".json") and entry.is_file(follow_symlinks=False):
+                try:
+                    os.remove(entry.path)
+                    removed += 1
+                except OSError:
+                    pass
+        return removed
+    
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+    
+    def set(self, key: str, value: Any) -> None:
+        with self.lock:
+            self.memory[key] = value
+        
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp_path, "wb") as fh:
+                fh.write(orjson.dumps(value))
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+
+RESULT_CACHE = ResultCache(CACHE_DIR, CACHE_TTL_SECONDS, CACHE_MAX_ENTRIES)
+LLM_CACHE = ResultCache(os.path.join(CACHE_DIR, "llm"), CACHE_TTL_SECONDS, CACHE_MAX_ENTRIES)
@@ -1,8 +1,81 @@
 import os
-from typing import Dict, Any
+import subprocess
+from typing import Dict, Any, List
 
 MAX_TREE_LINES = 300
 MAX_FILE_SIZE_KB = 40
+MAX_KEY_FILE_CHARS = 2000
+COMPONENT_TREE_LINES = 50
+GIT_NETWORK_TIMEOUT_SECONDS = 300
+
+IGNORE_DIRS = frozenset([
+    "node_modules", ".venv", "venv", "env", "dist", "build",
+    "__pycache__", ".git", ".idea", ".vscode", ".pytest_cache",
+    ".mypy_cache", "target", "bin", "obj", ".gradle"
+])
+IGNORE_FILE_EXTENSIONS = (".pyc", ".pyo", ".pyd", ".so", ".dll", ".exe", ".dylib")
+
+CONFIG_PATTERNS = [
+    "package.json", "requirements.txt", "Dockerfile", "docker-compose.yml",
+    "pom.xml", "build.gradle", "Cargo.toml", "go.mod", "composer.json",
+    "Gemfile", "Pipfile", ".env.example", "Makefile", "CMakeLists.txt"
+]
+CONFIG_BY_NAME = {pattern.lower(): pattern for pattern in CONFIG_PATTERNS}
+CONFIG_PREFIXES = tuple(CONFIG_BY_NAME)
+
+BUILD_FILE_PATTERNS = frozenset(["pom.xml", "build.gradle", "package.json", "go.mod"])
+TECH_BY_PATTERN = {
+    "pom.xml": "Java",
+    "build.gradle": "Java",
+    "package.json": "Node.js",
+    "go.mod": "Go",
+    "requirements.txt": "Python",
+    "Pipfile": "Python"
+}
+
+def run_git(
+    repo_path: str, *args: str, input: bytes = None, check: bool = True, timeout: float = None
+) -> bytes:
+    return subprocess.run(
+        ["git", "-C", repo_path, *args],
+        input=input,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        check=check,
+        timeout=timeout,
+        env={**os.environ, "GIT_TERMINAL_PROMPT": "0"}
+    ).stdout
+
+def read_blobs(repo_path: str, shas: List[str]) -> Dict[str, bytes]:
+    if not shas:
+        return {}
+    
+    request = "".join(sha + "\n" for sha in shas).encode()
+    # En un clone parcial los blobs no están en local: se piden todos en un solo fetch
+    # en lugar de dejar que cat-file los descargue de uno en uno.
+    run_git(
+        repo_path, "-c", "fetch.negotiationAlgorithm=noop", "fetch", "-q", "origin",
+        "--no-tags", "--no-write-fetch-head", "--recurse-submodules=no",
+        "--filter=blob:none", "--stdin",
+        input=request, check=False, timeout=GIT_NETWORK_TIMEOUT_SECONDS
+    )
+    output = run_git(
+        repo_path, "cat-file", "--batch", input=request, timeout=GIT_NETWORK_TIMEOUT_SECONDS
+    )
+    
+    blobs = {}
+    pos = 0
+    while pos < len(output):
+        header_end = output.index(b"\n", pos)
+        header = output[pos:header_end].split()
+        pos = header_end + 1
+        if len(header) != 3:
+            continue
+        size = int(header[2])
+        blobs[header[0].decode()] = output[pos:pos + size]
+        pos += size + 1
+    
+    return blobs
 
 def extract_repository_structure(repo_path: str, max_depth: int = 3) -> Dict[str, Any]:
     structure = {
@@ -12,90 +85,102 @@ def extract_repository_structure(repo_path: str, max_depth: int = 3) -> Dict[str
         "modules": [],
         "config_files": [],
         "endpoints": [],
-        "technologies": []
+        "technologies": [],
+        "components": []
     }
     
-    ignore_dirs = [
-        "node_modules", ".venv", "venv", "env", "dist", "build", 
-        "__pycache__", ".git", ".idea", ".vscode", ".pytest_cache",
-        ".mypy_cache", "target", "bin", "obj", ".gradle"
-    ]
-    ignore_files = {".pyc", ".pyo", ".pyd", ".so", ".dll", ".exe", ".dylib"}
-    
-    config_patterns = [
-        "package.json", "requirements.txt", "Dockerfile", "docker-compose.yml",
-        "pom.xml", "build.gradle", "Cargo.toml", "go.mod", "composer.json",
-        "Gemfile", "Pipfile", ".env.example", "Makefile", "CMakeLists.txt"
-    ]
-    
     max_file_size = MAX_FILE_SIZE_KB * 1024
-    lines = []
-    modules = set()
     
-    for root, dirs, files in os.walk(repo_path):
-        dirs[:] = [d for d in dirs if d not in ignore_dirs and not d.startswith(".")]
-        
-        rel = os.path.relpath(root, repo_path)
-        if rel == ".":
-            depth = 0
-        else:
-            depth = len(rel.split(os.sep))
-            if depth == 1:
-                modules.add(os.path.basename(root))
+    tree = {b"": ([], [])}
+    listing = run_git(repo_path, "ls-tree", "-r", "-t", "-z", "HEAD")
+    for entry in listing.split(b"\0"):
+        if not entry:
+            continue
         
-        if depth > max_depth:
-            dirs.clear()
+        meta, path = entry.split(b"\t", 1)
+        parent, _, raw_name = path.rpartition(b"/")
+        if parent not in tree:
             continue
         
+        obj_type, sha = meta.split()[1:]
+        name = os.fsdecode(raw_name)
+        if obj_type == b"blob":
+            tree[parent][1].append((name, sha.decode()))
+        elif name not in IGNORE_DIRS and not name.startswith(".") and path.count(b"/") < max_depth:
+            tree[path] = ([], [])
+            tree[parent][0].append(path)
+    
+    indents = ["  " * i for i in range(max_depth + 2)]
+    lines = []
+    modules = {os.fsdecode(path) for path in tree[b""][0]}
+    technologies = set()
+    candidates = []
+    
+    stack = [(b"", 0)]
+    while stack:
+        key, depth = stack.pop()
+        subdirs, files = tree[key]
+        rel = os.fsdecode(key)
+        
         if len(lines) >= MAX_TREE_LINES:
-            lines.append("  " * (depth + 1) + "... (truncado)")
+            lines.append(indents[depth + 1] + "... (truncado)")
             break
         
-        if rel != ".":
-            lines.append("  " * depth + os.path.basename(root) + "/")
+        if rel:
+            dir_name = rel.rpartition("/")[2]
+            if len(lines) < COMPONENT_TREE_LINES:
+                structure["components"].append(dir_name)
+            lines.append(indents[depth] + dir_name + "/")
         
         file_count = 0
-        for f in sorted(files):
+        # git ls-tree ya entrega las entradas de cada directorio ordenadas por nombre.
+        for f, sha in files:
             if file_count >= 20:
-                lines.append("  " * (depth + 1) + "... (más archivos)")
+                lines.append(indents[depth + 1] + "... (más archivos)")
                 break
             
-            if f.startswith(".") or any(f.endswith(ext) for ext in ignore_files):
+            if f.startswith(".") or f.endswith(IGNORE_FILE_EXTENSIONS):
                 continue
             
-            lines.append("  " * (depth + 1) + f)
+            lines.append(indents[depth + 1] + f)
             file_count += 1
             
-            file_path = os.path.join(root, f)
-            for pattern in config_patterns:
-                if f.lower() == pattern.lower() or f.lower().startswith(pattern.lower()):
-                    try:
-                        if os.path.getsize(file_path) <= max_file_size:
-                            with open(file_path, 'r', encoding='utf-8', errors='ignore') as fh:
-                                content = fh.read(2000)
-                                rel_path = os.path.relpath(file_path, repo_path)
-                                structure["key_files"][rel_path] = content
-                                
-                                if pattern in ["pom.xml", "build.gradle", "package.json", "go.mod"]:
-                                    structure["config_files"].append(rel_path)
-                                    if "dependency" in content.lower() or "dependencies" in content.lower():
-                                        structure["dependencies"][rel_path] = "detected"
-                                    
-                                    if "pom.xml" in pattern or "build.gradle" in pattern:
-                                        structure["technologies"].append("Java")
-                                    elif "package.json" in pattern:
-                                        structure["technologies"].append("Node.js")
-                                    elif "go.mod" in pattern:
-                                        structure["technologies"].append("Go")
-                                    elif "requirements.txt" in pattern or "Pipfile" in pattern:
-                                        structure["technologies"].append("Python")
-                    except Exception:
-                        pass
-                    break
+            fl = f.lower()
+            pattern = CONFIG_BY_NAME.get(fl)
+            if pattern is None and fl.startswith(CONFIG_PREFIXES):
+                pattern = next(CONFIG_BY_NAME[p] for p in CONFIG_PREFIXES if fl.startswith(p))
+            if pattern is not None:
+                candidates.append((f"{rel}/{f}" if rel else f, pattern, sha))
+        
+        stack.extend((path, depth + 1) for path in reversed(subdirs))
+    
+    try:
+        blobs = read_blobs(repo_path, [sha for _, _, sha in candidates])
+    except Exception:
+        blobs = {}
+    
+    for rel_path, pattern, sha in candidates:
+        raw = blobs.get(sha)
+        if raw is None or len(raw) > max_file_size:
+            continue
+        
+        # Un carácter UTF-8 ocupa como mucho 4 bytes: no hace falta decodificar el resto del blob.
+        content = raw[:MAX_KEY_FILE_CHARS * 4].decode("utf-8", errors="ignore")
+        content = content.replace("\r\n", "\n").replace("\r", "\n")[:MAX_KEY_FILE_CHARS]
+        structure["key_files"][rel_path] = content
+        
+        if pattern in BUILD_FILE_PATTERNS:
+            structure["config_files"].append(rel_path)
+            content_lower = content.lower()
+            if "dependency" in content_lower or "dependencies" in content_lower:
+                structure["dependencies"][rel_path] = "detected"
+        
+        tech = TECH_BY_PATTERN.get(pattern)
+        if tech:
+            technologies.add(tech)
     
     structure["tree"] = "\n".join(lines)
     structure["modules"] = sorted(list(modules))
-    structure["technologies"] = list(set(structure["technologies"]))
+    structure["technologies"] = sorted(technologies)
     
     return structure
-
@@ -1,105 +1,340 @@
 import os
-import json
-import re
-import requests
-from typing import Dict, Any
+import time
+import hashlib
+import asyncio
+import functools
+import aiohttp
+import orjson
+from typing import Dict, Any, List, Optional
 from fastapi import HTTPException
+from cache import LLM_CACHE
 
 OLLAMA_API_URL = os.getenv("OLLAMA_API_URL", "http://localhost:11434")
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "llama3.2:3b-instruct-q4_0")
+OLLAMA_CONCURRENCY = int(os.getenv("OLLAMA_CONCURRENCY", "1"))
+OLLAMA_QUEUE_TIMEOUT_SECONDS = int(os.getenv("OLLAMA_QUEUE_TIMEOUT_SECONDS", "60"))
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+OLLAMA_NUM_THREAD = int(os.getenv("OLLAMA_NUM_THREAD", str(max(2, (os.cpu_count() or 4) - 1))))
+# Opciones de carga del modelo: si la precarga y las generaciones no coinciden
+# Ollama vuelve a cargar el modelo.
+OLLAMA_OPTIONS = {"num_thread": OLLAMA_NUM_THREAD}
 
-def call_ollama(prompt: str, max_tokens: int = 2000) -> str:
+SESSION: Optional[aiohttp.ClientSession] = None
+OLLAMA_SEMAPHORE = asyncio.Semaphore(OLLAMA_CONCURRENCY)
+OLLAMA_METRICS = {
+    "in_flight": 0,
+    "queued": 0,
+    "rejected": 0,
+    "generations": 0,
+    "generation_seconds": 0.0,
+    "failures": 0
+}
+
+MERMAID_KEYWORDS = ("flowchart", "graph")
+SMALL_REPO_COMPONENTS = 6
+MAX_PROMPT_COMPONENTS = 40
+
+# Las instrucciones no dependen del repositorio: van como prompt de sistema fijo para que
+# Ollama reutilice su caché de prefijo entre peticiones.
+SYSTEM_PROMPT = """Generas diagramas Mermaid de arquitectura a partir de la estructura de un repositorio.
+
+INSTRUCCIONES CRÍTICAS:
+
+1. USA SOLO los nombres EXACTOS que aparecen en "COMPONENTES REALES ENCONTRADOS" y "MÓDULOS"
+2. NO uses texto genérico como "MÓDULOS DETECTADOS", "Componente 1", "Capa 1", etc.
+3. Si hay módulos como "drivers", "payments", "rides", "users" - usa esos nombres EXACTOS
+4. Si hay archivos como "pom.xml", "README.md" - inclúyelos con sus nombres reales
+
+SINTAXIS:
+- Primera línea: flowchart TD
+- Nodos: A[NombreReal] donde NombreReal es el nombre exacto del componente
+- Relaciones: A --> B (solo -->)
+- Indentación: 4 espacios
+
+EJEMPLO CORRECTO (si hay módulos drivers, payments):
+```mermaid
+flowchart TD
+    A[drivers]
+    B[payments]
+    C[rides]
+    D[users]
+    A --> E[pom.xml]
+    B --> F[pom.xml]
+```
+
+EJEMPLO INCORRECTO (NO hagas esto):
+```mermaid
+flowchart TD
+    A[MÓDULOS DETECTADOS]
+    A --> B[Módulo 1]
+```
+(INCORRECTO: usa nombres genéricos en lugar de los reales)"""
+
+MODEL_CHECK_TTL = 30
+_MODEL_CHECK_CACHE = {"ts": 0.0, "ok": False}
+
+async def open_session() -> None:
+    global SESSION
+    SESSION = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=60)
+    )
+
+async def close_session() -> None:
+    if SESSION is not None:
+        await SESSION.close()
+
+def record_model_check(models_data: Dict[str, Any]) -> bool:
+    available = OLLAMA_MODEL in (model.get("name", "") for model in models_data.get("models", []))
+    _MODEL_CHECK_CACHE["ts"] = time.monotonic()
+    _MODEL_CHECK_CACHE["ok"] = available
+    return available
+
+async def ollama_status() -> str:
     try:
-        health_check = requests.get(f"{OLLAMA_API_URL}/api/tags", timeout=5)
-        if health_check.status_code != 200:
-            raise HTTPException(
-                status_code=503,
-                detail=f"Ollama no está disponible en {OLLAMA_API_URL}"
-            )
-        
-        models_response = requests.get(f"{OLLAMA_API_URL}/api/tags", timeout=5)
-        if models_response.status_code == 200:
-            models_data = models_response.json()
-            available_models = [model.get("name", "") for model in models_data.get("models", [])]
-            if OLLAMA_MODEL not in available_models:
+        async with SESSION.get(
+            f"{OLLAMA_API_URL}/api/tags",
+            timeout=aiohttp.ClientTimeout(total=5, connect=2)
+        ) as response:
+            if response.status != 200:
+                return "disconnected"
+            models_data = await response.json(loads=orjson.loads)
+    except Exception:
+        return "disconnected"
+    
+    # El sondeo periódico mantiene fresca la comprobación del modelo, así /analyze no
+    # necesita consultar /api/tags en cada petición.
+    record_model_check(models_data)
+    return "connected"
+
+async def warm_model() -> None:
+    # Un generate sin prompt solo carga el modelo en memoria.
+    try:
+        async with SESSION.post(
+            f"{OLLAMA_API_URL}/api/generate",
+            data=orjson.dumps({
+                "model": OLLAMA_MODEL,
+                "keep_alive": OLLAMA_KEEP_ALIVE,
+                "options": OLLAMA_OPTIONS
+            }),
+            headers={"Content-Type": "application/json"},
+            timeout=aiohttp.ClientTimeout(total=600)
+        ) as response:
+            await response.read()
+    except Exception:
+        pass
+
+async def check_model_available() -> None:
+    if _MODEL_CHECK_CACHE["ok"] and time.monotonic() - _MODEL_CHECK_CACHE["ts"] < MODEL_CHECK_TTL:
+        return
+    
+    try:
+        async with SESSION.get(
+            f"{OLLAMA_API_URL}/api/tags",
+            timeout=aiohttp.ClientTimeout(total=5)
+        ) as models_response:
+            if models_response.status != 200:
                 raise HTTPException(
                     status_code=503,
-                    detail=f"Modelo '{OLLAMA_MODEL}' no está disponible. Ejecuta: ollama pull {OLLAMA_MODEL}"
+                    detail=f"Ollama no está disponible en {OLLAMA_API_URL}"
                 )
-    except requests.exceptions.ConnectionError:
+            
+            models_data = await models_response.json(loads=orjson.loads)
+    except aiohttp.ClientConnectionError:
         raise HTTPException(
             status_code=503,
             detail=f"No se puede conectar con Ollama en {OLLAMA_API_URL}"
         )
     
+    if not record_model_check(models_data):
+        raise HTTPException(
+            status_code=503,
+            detail=f"Modelo '{OLLAMA_MODEL}' no está disponible. Ejecuta: ollama pull {OLLAMA_MODEL}"
+        )
+
+async def acquire_ollama_slot() -> None:
+    OLLAMA_METRICS["queued"] += 1
     try:
-        response = requests.post(
+        async with asyncio.timeout(OLLAMA_QUEUE_TIMEOUT_SECONDS):
+            await OLLAMA_SEMAPHORE.acquire()
+    except asyncio.TimeoutError:
+        OLLAMA_METRICS["rejected"] += 1
+        raise HTTPException(
+            status_code=503,
+            detail="Ollama está ocupado con otras peticiones, inténtalo de nuevo en unos minutos"
+        )
+    finally:
+        OLLAMA_METRICS["queued"] -= 1
+
+async def call_ollama(prompt: str, max_tokens: int = 2000, system: str = "") -> str:
+    cache_key = hashlib.sha256(
+        orjson.dumps(
+            {"model": OLLAMA_MODEL, "system": system, "prompt": prompt, "n": max_tokens},
+            option=orjson.OPT_SORT_KEYS
+        )
+    ).hexdigest()
+    cached = await asyncio.to_thread(LLM_CACHE.get, cache_key)
+    if cached is not None:
+        return cached
+    
+    await check_model_available()
+    await acquire_ollama_slot()
+    OLLAMA_METRICS["in_flight"] += 1
+    started = time.monotonic()
+    completed = False
+    
+    try:
+        async with SESSION.post(
             f"{OLLAMA_API_URL}/api/generate",
-            json={
+            data=orjson.dumps({
                 "model": OLLAMA_MODEL,
+                "system": system,
                 "prompt": prompt,
-                "stream": False,
+                "stream": True,
+                "keep_alive": OLLAMA_KEEP_ALIVE,
                 "options": {
+                    **OLLAMA_OPTIONS,
                     "temperature": 0.1,
-                    "num_predict": max_tokens,
-                    "num_thread": 2
+                    "num_predict": max_tokens
                 }
-            },
-            timeout=1200
-        )
-        response.raise_for_status()
-        result = response.json()
-        return result.get("response", "")
-    except requests.exceptions.HTTPError as e:
-        if e.response.status_code == 404:
+            }),
+            headers={"Content-Type": "application/json"},
+            timeout=aiohttp.ClientTimeout(total=1200)
+        ) as response:
+            response.raise_for_status()
+            text = ""
+            scanned = 0
+            async for line in response.content:
+                if not line.strip():
+                    continue
+                chunk = orjson.loads(line)
+                if "error" in chunk:
+                    raise HTTPException(status_code=503, detail=f"Error de Ollama: {chunk['error']}")
+                text += chunk.get("response", "")
+                if chunk.get("done"):
+                    break
+                # Con el bloque Mermaid ya cerrado el resto es texto que se descarta: al salir
+                # sin leer el cuerpo se cierra la conexión y Ollama deja de generar.
+                if text.find("```", max(scanned - 2, 0)) != -1 and find_fenced_mermaid(text) is not None:
+                    break
+                scanned = len(text)
+        completed = True
+        if text:
+            await asyncio.to_thread(LLM_CACHE.set, cache_key, text)
+        return text
+    except aiohttp.ClientResponseError as e:
+        if e.status == 404:
+            _MODEL_CHECK_CACHE["ok"] = False
             raise HTTPException(
                 status_code=503,
                 detail=f"Modelo '{OLLAMA_MODEL}' no encontrado. Ejecuta: ollama pull {OLLAMA_MODEL}"
             )
         raise HTTPException(status_code=503, detail=f"Error HTTP de Ollama: {str(e)}")
-    except requests.exceptions.Timeout:
+    except asyncio.TimeoutError:
         raise HTTPException(status_code=504, detail="Ollama no respondió en 20 minutos")
-    except requests.exceptions.RequestException as e:
+    except aiohttp.ClientError as e:
         raise HTTPException(status_code=503, detail=f"Error al conectar con Ollama: {str(e)}")
+    finally:
+        OLLAMA_METRICS["in_flight"] -= 1
+        if completed:
+            OLLAMA_METRICS["generations"] += 1
+            OLLAMA_METRICS["generation_seconds"] += time.monotonic() - started
+        else:
+            OLLAMA_METRICS["failures"] += 1
+        OLLAMA_SEMAPHORE.release()
+
+def starts_with_mermaid_keyword(code: str) -> bool:
+    lines = code.strip().splitlines()
+    start = 0
+    # El front-matter (---) y las directivas %% pueden ir antes del tipo de diagrama.
+    if lines and lines[0].strip() == "---":
+        start = next((i + 1 for i in range(1, len(lines)) if lines[i].strip() == "---"), len(lines))
+    for line in lines[start:]:
+        line = line.strip()
+        if line and not line.startswith("%%"):
+            return line.split(None, 1)[0].lower() in MERMAID_KEYWORDS
+    return False
 
+def find_fenced_mermaid(text: str) -> Optional[str]:
+    lower_text = text.lower()
+    untagged_code = None
+    
+    fence_start = lower_text.find("```")
+    while fence_start != -1:
+        info_end = text.find("\n", fence_start + 3)
+        if info_end == -1:
+            break
+        fence_end = text.find("```", info_end + 1)
+        if fence_end == -1:
+            break
+        
+        info = lower_text[fence_start + 3:info_end].strip()
+        if info in ("mermaid", ""):
+            code = text[info_end + 1:fence_end].strip()
+            if starts_with_mermaid_keyword(code):
+                if info:
+                    return code
+                if untagged_code is None:
+                    untagged_code = code
+        
+        fence_start = lower_text.find("```", fence_end + 3)
+    
+    return untagged_code
+
+@functools.lru_cache(maxsize=64)
 def extract_mermaid_code(text: str) -> str:
-    mermaid_patterns = [
-        r"```mermaid\s*\n(.*?)```",
-        r"```\s*\n(.*?)```",
-        r"flowchart\s+TD\s*\n(.*?)(?=\n\n|\Z|```)",
-        r"graph\s+TD\s*\n(.*?)(?=\n\n|\Z|```)",
-    ]
-    
-    for pattern in mermaid_patterns:
-        match = re.search(pattern, text, re.DOTALL | re.IGNORECASE)
-        if match:
-            code = match.group(1).strip()
-            if any(keyword in code.lower() for keyword in ["graph", "flowchart"]):
-                return code
-    
-    lines = text.split("\n")
+    fenced_code = find_fenced_mermaid(text)
+    if fenced_code is not None:
+        return fenced_code
+    
     mermaid_lines = []
-    in_mermaid = False
+    preamble = []
+    in_front_matter = False
     
-    for line in lines:
+    for line in text.splitlines():
         line_stripped = line.strip()
-        line_lower = line_stripped.lower()
         
-        if any(keyword in line_lower for keyword in ["graph", "flowchart"]):
-            in_mermaid = True
-            mermaid_lines.append(line_stripped)
-        elif in_mermaid:
+        if mermaid_lines:
+            if line_stripped.startswith("```"):
+                break
             if line_stripped:
                 mermaid_lines.append(line_stripped)
             elif len(mermaid_lines) > 2:
                 break
+        elif starts_with_mermaid_keyword(line_stripped):
+            mermaid_lines = ([] if in_front_matter else preamble) + [line_stripped]
+        elif in_front_matter:
+            preamble.append(line_stripped)
+            in_front_matter = line_stripped != "---"
+        elif line_stripped == "---" or line_stripped.startswith("%%"):
+            if line_stripped == "---" and not preamble:
+                in_front_matter = True
+            preamble.append(line_stripped)
+        elif line_stripped:
+            preamble = []
     
     if mermaid_lines:
         return "\n".join(mermaid_lines)
     
     return text.strip()
 
-def generate_mermaid_diagram(structure: Dict[str, Any]) -> str:
+def build_simple_diagram(components_list: List[str], key_files: Dict[str, str]) -> str:
+    ids = {name: f"N{i}" for i, name in enumerate(components_list)}
+    lines = ["flowchart TD"]
+    for name, node_id in ids.items():
+        label = name.replace('"', "'")
+        lines.append(f'    {node_id}["{label}"]')
+    
+    edges = {}
+    for file_path in key_files:
+        parent, _, file_name = file_path.rpartition("/")
+        top = parent.partition("/")[0]
+        if top in ids and file_name in ids and top != file_name:
+            edges[f"    {ids[top]} --> {ids[file_name]}"] = None
+    lines.extend(edges)
+    
+    return "\n".join(lines)
+
+async def generate_mermaid_diagram(structure: Dict[str, Any]) -> str:
     tree_summary = structure["tree"][:2000]
     modules = structure["modules"]
     technologies = structure["technologies"]
@@ -108,23 +343,29 @@ def generate_mermaid_diagram(structure: Dict[str, Any]) -> str:
     seen = set()
     
     for module in modules:
-        if module and module not in seen:
+        key = module.casefold()
+        if module and key not in seen:
             components_list.append(module)
-            seen.add(module.lower())
+            seen.add(key)
     
-    for line in tree_summary.split('\n')[:50]:
-        line = line.strip()
-        if line and not line.startswith('.') and '/' in line:
-            dir_name = line.split('/')[0].strip()
-            if dir_name and dir_name.lower() not in seen and len(dir_name) > 1:
-                components_list.append(dir_name)
-                seen.add(dir_name.lower())
+    for dir_name in structure["components"]:
+        key = dir_name.casefold()
+        if key not in seen and len(dir_name) > 1:
+            components_list.append(dir_name)
+            seen.add(key)
     
     for file_path in list(structure["key_files"].keys())[:5]:
-        file_name = os.path.basename(file_path)
-        if file_name and file_name.lower() not in seen:
+        file_name = file_path.rpartition("/")[2]
+        key = file_name.casefold()
+        if file_name and key not in seen:
             components_list.append(file_name)
-            seen.add(file_name.lower())
+            seen.add(key)
+    
+    # Módulos primero, luego directorios y archivos clave: el recorte conserva lo más relevante.
+    del components_list[MAX_PROMPT_COMPONENTS:]
+    
+    if len(modules) <= 1 and 0 < len(components_list) <= SMALL_REPO_COMPONENTS:
+        return build_simple_diagram(components_list, structure["key_files"])
     
     prompt = f"""Genera un diagrama Mermaid de arquitectura basado en esta estructura de repositorio.
 
@@ -134,47 +375,16 @@ ESTRUCTURA DEL REPOSITORIO:
 COMPONENTES REALES ENCONTRADOS:
 {', '.join(components_list) if components_list else 'Ninguno detectado'}
 
-MÓDULOS: {', '.join(modules) if modules else 'Ninguno'}
+MÓDULOS: {', '.join(modules[:MAX_PROMPT_COMPONENTS]) if modules else 'Ninguno'}
 TECNOLOGÍAS: {', '.join(technologies) if technologies else 'Desconocidas'}
 
-INSTRUCCIONES CRÍTICAS:
-
-1. USA SOLO los nombres EXACTOS que aparecen en "COMPONENTES REALES ENCONTRADOS" y "MÓDULOS"
-2. NO uses texto genérico como "MÓDULOS DETECTADOS", "Componente 1", "Capa 1", etc.
-3. Si hay módulos como "drivers", "payments", "rides", "users" - usa esos nombres EXACTOS
-4. Si hay archivos como "pom.xml", "README.md" - inclúyelos con sus nombres reales
-
-SINTAXIS:
-- Primera línea: flowchart TD
-- Nodos: A[NombreReal] donde NombreReal es el nombre exacto del componente
-- Relaciones: A --> B (solo -->)
-- Indentación: 4 espacios
-
-EJEMPLO CORRECTO (si hay módulos drivers, payments):
-```mermaid
-flowchart TD
-    A[drivers]
-    B[payments]
-    C[rides]
-    D[users]
-    A --> E[pom.xml]
-    B --> F[pom.xml]
-```
-
-EJEMPLO INCORRECTO (NO hagas esto):
-```mermaid
-flowchart TD
-    A[MÓDULOS DETECTADOS]
-    A --> B[Módulo 1]
-```
-(INCORRECTO: usa nombres genéricos en lugar de los reales)
-
 Genera SOLO el código Mermaid válido usando los nombres REALES de los componentes:"""
 
-    llm_output = call_ollama(prompt, max_tokens=2000)
+    max_tokens = min(2000, 400 + 80 * len(components_list))
+    llm_output = await call_ollama(prompt, max_tokens=max_tokens, system=SYSTEM_PROMPT)
     mermaid_code = extract_mermaid_code(llm_output)
     
-    if not mermaid_code.strip().startswith(('flowchart', 'graph')):
+    if not starts_with_mermaid_keyword(mermaid_code):
         mermaid_code = "flowchart TD\n" + mermaid_code
     
     return mermaid_code